@@ -1,26 +1,81 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
 
 from models import *
 
-class WorkflowAdmin(admin.ModelAdmin):
-    list_display = ('name', 'cloned_from')
-    list_filter = ('cloned_from', 'belong_to')
+class EstimatedCountPaginator(Paginator):
+    """use postgresql statistics instead of COUNT(*) for unfiltered changelists"""
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if connection.vendor == 'postgresql' and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                    [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > 0:
+                return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+def foreign_keys(model):
+    return tuple(f.name for f in model._meta.get_fields()
+        if f.concrete and f.many_to_one)
+
+def related_fields(model):
+    return foreign_keys(model) + tuple(f.name for f in model._meta.get_fields()
+        if f.many_to_many and not f.auto_created)
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class WorkflowAdmin(LargeTableAdmin):
+    list_display = ('name', 'cloned_from', 'belong_to', 'status')
+    list_filter = ('status',)
+    list_select_related = ('cloned_from', 'belong_to')
+    raw_id_fields = ('cloned_from', 'belong_to')
+    search_fields = ('name',)
     ordering = ('cloned_from',)
 
+class WorkflowActivityAdmin(LargeTableAdmin):
+    list_display = ('name', 'workflow', 'status', 'real_start_time', 'completed_on')
+    list_filter = ('status',)
+    list_select_related = ('workflow',)
+    raw_id_fields = ('workflow',)
+    search_fields = ('name',)
+
 class TransitionAdmin(admin.ModelAdmin):
-    list_filter = ('workflow',)
+    list_display = ('name', 'workflow', 'from_state', 'to_state')
+    list_select_related = ('workflow', 'from_state', 'to_state')
+    raw_id_fields = ('workflow', 'from_state', 'to_state')
 
 class StateAdmin(admin.ModelAdmin):
-    list_filter = ('workflow',)
+    list_display = ('name', 'workflow', 'state_type')
+    list_select_related = ('workflow',)
+    raw_id_fields = ('workflow',)
+
+class ParticipantAdmin(LargeTableAdmin):
+    list_select_related = foreign_keys(Participant)
+    raw_id_fields = related_fields(Participant)
+    search_fields = ('executor',)
+
+class RecordAdmin(LargeTableAdmin):
+    list_select_related = foreign_keys(Record)
+    raw_id_fields = related_fields(Record)
 
-class HistoryAdmin(admin.ModelAdmin):
-    list_filter = ('workflowactivity',)
+class HistoryAdmin(LargeTableAdmin):
+    list_display = ('workflowactivity', 'state', 'created_on')
+    list_select_related = ('workflowactivity', 'state')
+    raw_id_fields = ('workflowactivity', 'state')
 
 
 admin.site.register(Workflow, WorkflowAdmin)
-admin.site.register(WorkflowActivity)
-admin.site.register(Participant)
+admin.site.register(WorkflowActivity, WorkflowActivityAdmin)
+admin.site.register(Participant, ParticipantAdmin)
 admin.site.register(State, StateAdmin)
 admin.site.register(Transition, TransitionAdmin)
-admin.site.register(Record)
-admin.site.register(WorkflowHistory, HistoryAdmin)
\ No newline at end of file
+admin.site.register(Record, RecordAdmin)
+admin.site.register(WorkflowHistory, HistoryAdmin)
@@ -0,0 +1,67 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+build the graphviz source of a workflow in a constant number of queries:
+one for the states, one for the transitions and one for the history.
+
+state colors follow the three statuses the old state.dot template used
+(undo grey, processing red, anything else green). State.get_status ran
+one query per state for them; here a state is processing when it is one
+of the active states passed in, done when the activity's history has
+passed through it, and undo otherwise.
+"""
+from . import models
+
+SHAPES = {
+    2: 'shape=box, ',
+    3: 'shape=polygon, sides=4, orientation=45, ',
+    4: 'shape=polygon, sides=4, distortion=-.7, ',
+    5: 'shape=polygon, sides=4, distortion=.4, ',
+}
+
+COLORS = {
+    'undo': 'grey',
+    'processing': 'red',
+    'done': 'green',
+}
+
+def text(value):
+    return u'%s' % value if value is not None else u''
+
+def escape(value):
+    return text(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def build_skeleton(workflow):
+    nodes = []
+    for pk, name, state_type in workflow.states.values_list(
+            'pk', 'name', 'state_type').order_by('pk'):
+        nodes.append((pk, u'    state%d [%sfillcolor="' % (pk, SHAPES.get(state_type, '')),
+            u'", style=filled, label="%s %d"]' % (escape(name), pk)))
+    edges = [u'    state%d -> state%d [label="%s %s"];' % (
+            from_state, to_state, escape(name), escape(condition))
+        for from_state, to_state, name, condition in workflow.transitions.values_list(
+            'from_state_id', 'to_state_id', 'name', 'condition').order_by('pk')]
+    header = u'/*\nA definition for a diagram of the workflow: %s\n*/\ndigraph G {\n' \
+        u'    subgraph cluster_level1 {\n    label="workflow"\n' % text(workflow.name).replace('*/', '')
+    return {'header': header, 'nodes': nodes, 'edges': edges}
+
+def get_visited_states(workflow):
+    return set(models.WorkflowHistory.objects.filter(
+        workflowactivity__workflow=workflow).values_list('state_id', flat=True))
+
+def get_dotfile(workflow, current_states=None):
+    skeleton = build_skeleton(workflow)
+    processing = set(getattr(s, 'pk', s) for s in current_states or ())
+    visited = get_visited_states(workflow)
+    lines = [skeleton['header']]
+    for pk, prefix, suffix in skeleton['nodes']:
+        if pk in processing:
+            status = 'processing'
+        elif pk in visited:
+            status = 'done'
+        else:
+            status = 'undo'
+        lines.append(prefix + COLORS[status] + suffix)
+    lines.extend(skeleton['edges'])
+    lines.append(u'    }\n}\n')
+    return u'\n'.join(lines)
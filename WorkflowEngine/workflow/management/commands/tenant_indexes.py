@@ -0,0 +1,61 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from workflow import models
+
+# (model, index suffix, fields); templates lead with the tenant column,
+# activities and histories only reach the tenant through their workflow
+# so they are indexed on the columns the views filter on
+TENANT_INDEXES = (
+    (models.Workflow, 'tenant_template', ('belong_to', 'cloned_from', 'status')),
+    (models.WorkflowActivity, 'workflow_status', ('workflow', 'status')),
+    (models.WorkflowHistory, 'activity_created', ('workflowactivity', 'created_on')),
+)
+
+
+class Command(BaseCommand):
+    help = 'Create composite indexes for tenant queries without locking writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only print the SQL statements')
+
+    def get_statements(self):
+        qn = connection.ops.quote_name
+        for model, suffix, fields in TENANT_INDEXES:
+            table = model._meta.db_table
+            columns = [model._meta.get_field(f).column for f in fields]
+            name = '%s_%s_idx' % (table, suffix)
+            yield name, 'CREATE INDEX CONCURRENTLY %s ON %s (%s)' % (
+                qn(name), qn(table), ', '.join(qn(c) for c in columns))
+
+    def get_index_state(self, cursor, name):
+        """None if missing, otherwise whether the index is valid"""
+        cursor.execute('SELECT i.indisvalid FROM pg_class c '
+            'JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s', [name])
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def execute(self, cursor, sql, dry_run):
+        self.stdout.write(sql)
+        if not dry_run:
+            cursor.execute(sql)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('tenant indexes require postgresql')
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        connection.set_autocommit(True)
+        with connection.cursor() as cursor:
+            for name, sql in self.get_statements():
+                # postgresql 9.4 has no CREATE INDEX IF NOT EXISTS
+                valid = self.get_index_state(cursor, name)
+                if valid:
+                    continue
+                if valid is not None:
+                    # a failed CREATE INDEX CONCURRENTLY leaves an INVALID index
+                    self.execute(cursor, 'DROP INDEX CONCURRENTLY %s' %
+                        connection.ops.quote_name(name), options['dry_run'])
+                self.execute(cursor, sql, options['dry_run'])
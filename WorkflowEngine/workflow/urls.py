@@ -14,6 +14,7 @@ urlpatterns = [
     url(r'^state/(?P<pk>[0-9]+)$', views.StateDetailView.as_view()),
     url(r'^workflow/(?P<pk>[0-9]+)/transition/$', views.TransitionListView.as_view(), name='template-transitions'),
     url(r'^transition/(?P<pk>[0-9]+)$', views.TransitionDetailView.as_view()),
+    url(r'^workflow/(?P<pk>[0-9]+)/graph/$', views.WorkflowGraphView.as_view(), name='template-graph'),
 
     # create workflow at a time
     url(r'^workflow/whole/$', views.WorkflowWholeparameterView.as_view()),
@@ -27,6 +28,7 @@ urlpatterns = [
 
 
     url(r'^workflowactivity/$', views.WorkflowActivityListView.as_view()),
+    url(r'^workflowactivity/summary/$', views.WorkflowActivitySummaryView.as_view(), name='instance-summary'),
     url(r'^workflowactivity/(?P<pk>[0-9]+)$', views.WorkflowActivityDetailView.as_view(), name="instance-detail"),
     
     url(r'^workflowactivity/(?P<ppk>[0-9]+)/state/(?P<pk>[0-9]+)$', views.WorkflowActivityStateDetailView.as_view()),
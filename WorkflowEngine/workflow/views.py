@@ -1,10 +1,17 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
-import logging, subprocess
+import hashlib, json, logging, subprocess
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ObjectDoesNotExist
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Case, Count, Q, Value, When
+from django.db.models.functions import Cast
+from django.utils import six
 
 from rest_framework import generics, status
 from rest_framework.views import APIView
@@ -12,13 +19,85 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.serializers import ValidationError
 
-from . import serializers, functions, models
+from . import serializers, functions, models, dotfile
 
 from error_list import error_list
 from errors import BadRequest, Http403
 
 logger = logging.getLogger('workflowapp')
 
+class IdempotentMixin(object):
+    """
+    replay the stored response when a mutation is retried with the same
+    Idempotency-Key header, without running the engine again
+    """
+    idempotency_header = 'HTTP_IDEMPOTENCY_KEY'
+    idempotency_cache = 'idempotency'
+
+    def get_idempotency_cache(self):
+        store = caches[self.idempotency_cache]
+        # a per-process cache would let retries routed to another worker run
+        # the engine again, the database cache counts and culls its whole
+        # table on every add(); only memcached or redis qualify
+        if not isinstance(store, BaseMemcachedCache) and \
+                'redis' not in type(store).__module__:
+            raise ImproperlyConfigured('CACHES["%s"] must be memcached or redis'
+                % self.idempotency_cache)
+        return store
+
+    def idempotency_cache_key(self, request, key):
+        digest = hashlib.md5(('%s:%s:%s' % (request.user.pk, request.path, key)
+            ).encode('utf8')).hexdigest()
+        return 'workflow:idempotency:%s' % digest
+
+    def request_digest(self, request):
+        data = request.data
+        if hasattr(data, 'lists'):
+            data = dict(data.lists())
+        return hashlib.md5(json.dumps(data, sort_keys=True, default=str
+            ).encode('utf8')).hexdigest()
+
+    def stored_response(self, stored, digest):
+        if stored['digest'] != digest:
+            return Response({'detail': 'Idempotency-Key reused with a different request body'},
+                status=422)
+        return Response(stored['data'], status=stored['status'])
+
+    def idempotent_response(self, handler, request, *args, **kwargs):
+        key = request.META.get(self.idempotency_header)
+        if not key:
+            return handler(request, *args, **kwargs)
+        store = self.get_idempotency_cache()
+        cache_key = self.idempotency_cache_key(request, key)
+        digest = self.request_digest(request)
+        stored = store.get(cache_key)
+        if stored is not None:
+            return self.stored_response(stored, digest)
+        ttl = getattr(settings, 'WORKFLOW_IDEMPOTENCY_TTL', 24*60*60)
+        lock_ttl = getattr(settings, 'WORKFLOW_IDEMPOTENCY_LOCK_TTL', 60)
+        if not store.add(cache_key+':lock', 1, lock_ttl):
+            return Response({'detail': 'Request with this Idempotency-Key is in progress'},
+                status=status.HTTP_409_CONFLICT)
+        try:
+            # the first request may have finished between get and add
+            stored = store.get(cache_key)
+            if stored is not None:
+                return self.stored_response(stored, digest)
+            response = handler(request, *args, **kwargs)
+            store.set(cache_key, {'data': response.data, 'digest': digest,
+                'status': response.status_code}, ttl)
+        finally:
+            store.delete(cache_key+':lock')
+        return response
+
+    def update(self, request, *args, **kwargs):
+        return self.idempotent_response(super(IdempotentMixin, self).update,
+            request, *args, **kwargs)
+
+    def create(self, request, *args, **kwargs):
+        return self.idempotent_response(super(IdempotentMixin, self).create,
+            request, *args, **kwargs)
+
 class WorkflowListView(generics.ListCreateAPIView):
     """
     get: 获取工作流模板     
@@ -160,11 +239,14 @@ class WorkflowDetailPngView(generics.RetrieveAPIView):
 
     def get(self, request, *args, **kwargs):
         workflow = self.get_object()
-        current_state = None
+        current_states = []
         try:
             if workflow.workflowactivity.status==models.WorkflowActivity.EXECUTE:
-                current_state = workflow.workflowactivity.current_state().state
-        except:
+                current = workflow.workflowactivity.current_state()
+                if current:
+                    current_states = [current.state]
+        except ObjectDoesNotExist:
+            # templates have no activity, fresh activities have no history
             pass
         proc = subprocess.Popen('%s -Tpng ' % 'dot',
             shell=True,
@@ -172,8 +254,8 @@ class WorkflowDetailPngView(generics.RetrieveAPIView):
             stdout=subprocess.PIPE
         )
         response = HttpResponse(content_type='image/png')
-        response.write(proc.communicate(functions.get_dotfile(workflow, 
-            current_state).encode('utf8'))[0])
+        response.write(proc.communicate(dotfile.get_dotfile(workflow, 
+            current_states).encode('utf8'))[0])
         return response
 
 
@@ -275,6 +357,253 @@ class TransitionDetailView(generics.RetrieveUpdateDestroyAPIView):
         return super(TransitionDetailView, self).perform_destroy(instance)
 
 
+class WorkflowGraphView(generics.GenericAPIView):
+    """
+    批量编辑流程模板的节点和流转方向, 一次请求在一个事务中完成     
+    patch参数格式:     
+    {"states": {"add": [...], "update": [{"id": 1, ...}], "delete": [2, 3]},     
+     "transitions": {"add": [...], "update": [...], "delete": [...]}}     
+    新增节点可带 "ref" 字段, 新增/修改的transition可用该ref作为from_state/to_state     
+    注意: serializer只用于校验字段, 写库走bulk_create和UPDATE语句, 不会调用
+    serializer的create()/update()和model的save(), 也不发送pre_save/post_save信号;
+    id, workflow由接口自身决定, 无法批量写入的字段(自定义through的多对多等)直接报错
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = models.Workflow.objects.all()
+    serializer_class = serializers.WorkflowDetailSerializer
+    endpoints = ('from_state', 'to_state')
+    view_owned = ('id', 'workflow')
+
+    def get_queryset(self):
+        return models.Workflow.objects.filter(
+            belong_to=self.request.user,
+            cloned_from=None)
+
+    def check_permission(self, instance):
+        if instance.status != models.Workflow.DEFINITION:
+            raise BadRequest(error_list['only_definition_allowed'])
+        if instance.cloned_from:
+            raise BadRequest(error_list['only_template_allowed'])
+        if instance.belong_to != self.request.user:
+            raise Http403('Only belong_to user can modified')
+
+    def to_pk(self, value, where):
+        if isinstance(value, bool) or not isinstance(value, six.integer_types+six.string_types):
+            raise BadRequest(error_list['parameter_error'], {where: 'invalid id'})
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest(error_list['parameter_error'], {where: 'invalid id'})
+
+    def get_items(self, diff, key, name):
+        items = diff.get(name) or []
+        if not isinstance(items, list):
+            raise BadRequest(error_list['parameter_error'], {key: '%s must be a list' % name})
+        if name == 'delete':
+            return set(self.to_pk(pk, '%s.delete' % key) for pk in items)
+        for item in items:
+            if not isinstance(item, dict):
+                raise BadRequest(error_list['parameter_error'],
+                    {key: '%s must be a list of objects' % name})
+        items = [dict(item) for item in items]
+        if name == 'update':
+            for item in items:
+                item['id'] = self.to_pk(item.get('id'), '%s.update' % key)
+        return items
+
+    def get_diff(self, data, key):
+        if not isinstance(data, dict):
+            raise BadRequest(error_list['parameter_error'], 'request body must be an object')
+        diff = data.get(key) or {}
+        if not isinstance(diff, dict):
+            raise BadRequest(error_list['parameter_error'], {key: 'must be an object'})
+        return [self.get_items(diff, key, name) for name in ('add', 'update', 'delete')]
+
+    def get_refs(self, items, states):
+        refs = []
+        for item in items:
+            ref = item.pop('ref', None)
+            if ref is not None:
+                if isinstance(ref, bool) or not isinstance(ref, six.integer_types+six.string_types):
+                    raise BadRequest(error_list['parameter_error'], {'ref': 'invalid ref'})
+                if ref in refs:
+                    raise BadRequest(error_list['parameter_error'], {'ref': 'duplicated ref %s' % ref})
+                try:
+                    collides = int(ref) in states
+                except ValueError:
+                    collides = False
+                if collides:
+                    raise BadRequest(error_list['parameter_error'],
+                        {'ref': 'ref %s is an existing state id' % ref})
+            refs.append(ref)
+        return refs
+
+    def check_fields(self, model, data):
+        """keep only fields the bulk path can write as they are"""
+        for key in self.view_owned:
+            data.pop(key, None)
+        for name in data:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            if field is not None and field.many_to_many:
+                writable = not field.auto_created and \
+                    field.remote_field.through._meta.auto_created
+            else:
+                writable = field is not None and field.concrete and not field.auto_created
+            if not writable:
+                raise BadRequest(error_list['parameter_error'],
+                    {name: 'cannot be edited through the graph endpoint'})
+        return data
+
+    def validate(self, model, serializer_class, items, instances=None, skip=()):
+        validated, errors = [], {}
+        for index, item in enumerate(items):
+            instance = instances.get(item['id']) if instances is not None else None
+            if instances is not None and instance is None:
+                errors[index] = {'id': 'not found in workflow'}
+                continue
+            serializer = serializer_class(instance, data=item, partial=instance is not None)
+            # fields resolved by the view itself, the related fields would
+            # otherwise run one query per value
+            for name in skip:
+                serializer.fields.pop(name, None)
+            if serializer.is_valid():
+                validated.append((instance,
+                    self.check_fields(model, dict(serializer.validated_data))))
+            else:
+                errors[index] = serializer.errors
+        return validated, errors
+
+    def resolve_endpoints(self, items, validated, states, refs):
+        """map from_state/to_state to an existing state pk or a new state ref"""
+        errors = {}
+        for index, (item, (instance, data)) in enumerate(zip(items, validated)):
+            for key in self.endpoints:
+                if key not in item:
+                    if instance is None:
+                        errors.setdefault(index, {})[key] = 'This field is required.'
+                    continue
+                value = item[key]
+                if not isinstance(value, bool) and isinstance(value,
+                        six.integer_types+six.string_types) and value in refs:
+                    data[key] = ('ref', value)
+                    continue
+                try:
+                    pk = self.to_pk(value, key)
+                except BadRequest:
+                    pk = None
+                if pk not in states:
+                    errors.setdefault(index, {})[key] = 'state not in workflow'
+                else:
+                    data[key] = ('pk', pk)
+        if errors:
+            raise BadRequest(error_list['state_workflow_not_match'], errors)
+
+    def m2m_fields(self, model):
+        return dict((f.name, f) for f in model._meta.many_to_many)
+
+    def set_relations(self, model, rows):
+        """rewrite m2m rows [(pk, name, values)] through the intermediate tables"""
+        fields = self.m2m_fields(model)
+        grouped = {}
+        for pk, name, values in rows:
+            grouped.setdefault(name, []).append((pk, values))
+        for name, rows in grouped.items():
+            field = fields[name]
+            through = field.remote_field.through
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            through.objects.filter(**{'%s__in' % source: [pk for pk, values in rows]}).delete()
+            through.objects.bulk_create([
+                through(**{'%s_id' % source: pk, '%s_id' % target: getattr(v, 'pk', v)})
+                for pk, values in rows for v in values])
+
+    def bulk_add(self, model, workflow, validated):
+        m2m = self.m2m_fields(model)
+        objs = [model(workflow=workflow, **dict((k, v) for k, v in data.items()
+            if k not in m2m)) for instance, data in validated]
+        # postgresql returns the primary keys of bulk inserted rows
+        objs = model.objects.bulk_create(objs)
+        self.set_relations(model, [(obj.pk, name, value)
+            for obj, (instance, data) in zip(objs, validated)
+            for name, value in data.items() if name in m2m])
+        return objs
+
+    def bulk_update(self, model, validated):
+        """one UPDATE ... CASE statement per changed field"""
+        m2m = self.m2m_fields(model)
+        columns, relations = {}, []
+        for instance, data in validated:
+            for name, value in data.items():
+                if name in m2m:
+                    relations.append((instance.pk, name, value))
+                else:
+                    columns.setdefault(name, []).append((instance.pk, value))
+        for name, rows in columns.items():
+            field = model._meta.get_field(name)
+            # untyped parameters in CASE resolve to text, cast them to the
+            # column type so jsonb, integer and date columns accept them
+            whens = [When(pk=pk, then=Cast(Value(getattr(value, 'pk', value),
+                output_field=field), field)) for pk, value in rows]
+            model.objects.filter(pk__in=[pk for pk, value in rows]).update(
+                **{name: Case(*whens, output_field=field)})
+        self.set_relations(model, relations)
+
+    @transaction.atomic
+    def patch(self, request, *args, **kwargs):
+        workflow = get_object_or_404(self.get_queryset().select_for_update(),
+            pk=int(self.kwargs['pk']))
+        self.check_permission(workflow)
+
+        state_add, state_update, state_delete = self.get_diff(request.data, 'states')
+        trans_add, trans_update, trans_delete = self.get_diff(request.data, 'transitions')
+        states = dict((s.pk, s) for s in workflow.states.all()
+            if s.pk not in state_delete)
+        # transitions of deleted states are removed by cascade
+        transitions = dict((t.pk, t) for t in workflow.transitions.all()
+            if t.pk not in trans_delete and t.from_state_id not in state_delete
+            and t.to_state_id not in state_delete)
+
+        # validate the whole diff before touching the database
+        refs = self.get_refs(state_add, states)
+        state_added, errors = self.validate(models.State, serializers.StateSerializer,
+            state_add)
+        state_updated, update_errors = self.validate(models.State,
+            serializers.StateSerializer, state_update, states)
+        if errors or update_errors:
+            raise BadRequest(error_list['parameter_error'],
+                {'states': {'add': errors, 'update': update_errors}})
+        trans_added, errors = self.validate(models.Transition,
+            serializers.TransitionModelSerializer, trans_add, skip=self.endpoints)
+        trans_updated, update_errors = self.validate(models.Transition,
+            serializers.TransitionModelSerializer, trans_update, transitions,
+            skip=self.endpoints)
+        if errors or update_errors:
+            raise BadRequest(error_list['parameter_error'],
+                {'transitions': {'add': errors, 'update': update_errors}})
+        ref_set = set(ref for ref in refs if ref is not None)
+        self.resolve_endpoints(trans_add, trans_added, states, ref_set)
+        self.resolve_endpoints(trans_update, trans_updated, states, ref_set)
+
+        models.Transition.objects.filter(workflow=workflow,
+            pk__in=trans_delete).delete()
+        models.State.objects.filter(workflow=workflow, pk__in=state_delete).delete()
+        objs = self.bulk_add(models.State, workflow, state_added)
+        self.bulk_update(models.State, state_updated)
+
+        created = dict((ref, obj) for ref, obj in zip(refs, objs) if ref is not None)
+        for instance, data in trans_added + trans_updated:
+            for key in self.endpoints:
+                if key in data:
+                    kind, value = data[key]
+                    data[key] = created[value] if kind == 'ref' else states[value]
+        self.bulk_add(models.Transition, workflow, trans_added)
+        self.bulk_update(models.Transition, trans_updated)
+
+        serializer = serializers.WorkflowDetailSerializer(workflow)
+        return Response(serializer.data)
+
 class WorkflowStatusView(generics.RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.Workflow.objects.all()
@@ -325,6 +654,23 @@ class WorkflowActivityListView(generics.ListCreateAPIView):
             return serializers.WorkflowActivitySimpleSerializer
         return self.serializer_class
 
+class WorkflowActivitySummaryView(APIView):
+    """
+    按流程模板和状态统计流程实例数量: 便捷接口, 每次请求对该用户的全部流程实例
+    做一次 GROUP BY 聚合, 开销随实例数增长, 不是计数表
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        rows = models.WorkflowActivity.objects.filter(
+            workflow__belong_to=request.user).values(
+            'workflow__cloned_from', 'status').annotate(
+            count=Count('id')).order_by()
+        return Response([{
+            'template': row['workflow__cloned_from'],
+            'status': row['status'],
+            'count': row['count']} for row in rows])
+
 class WorkflowActivityDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
@@ -335,7 +681,7 @@ class WorkflowActivityDetailView(generics.RetrieveUpdateDestroyAPIView):
             return serializers.WorkflowActivityDetailSerializer
         return self.serializer_class
 
-class WorkflowActivityCommitView(generics.RetrieveUpdateAPIView):
+class WorkflowActivityCommitView(IdempotentMixin, generics.RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
     serializer_class = serializers.CreatorSerializer
@@ -351,7 +697,7 @@ class WorkflowActivityCommitView(generics.RetrieveUpdateAPIView):
         if not success:
             raise ValidationError('commit faild')
 
-class WorkflowActivityStartView(generics.RetrieveUpdateAPIView):
+class WorkflowActivityStartView(IdempotentMixin, generics.RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
     serializer_class = serializers.CreatorSerializer
@@ -381,7 +727,7 @@ class WorkflowActivityStateDetailView(generics.RetrieveUpdateAPIView):
         return Response(serializers.StateSerializer(instance).data)
 
 
-class WorkflowActivityLogeventView(generics.ListCreateAPIView):
+class WorkflowActivityLogeventView(IdempotentMixin, generics.ListCreateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
     serializer_class = serializers.LogeventSerializer
@@ -413,7 +759,7 @@ class WorkflowActivityLogeventView(generics.ListCreateAPIView):
         else:
             raise BadRequest(error_list['parameter_error'])
 
-class WorkflowActivityAbolishView(generics.RetrieveUpdateAPIView):
+class WorkflowActivityAbolishView(IdempotentMixin, generics.RetrieveUpdateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
     serializer_class = serializers.CreatorSerializer
@@ -429,7 +775,7 @@ class WorkflowActivityAbolishView(generics.RetrieveUpdateAPIView):
         if not success:
             raise ValidationError('abolish faild')
 
-class WorkflowActivityDelegateView(generics.ListCreateAPIView):
+class WorkflowActivityDelegateView(IdempotentMixin, generics.ListCreateAPIView):
     permission_classes = (IsAuthenticated,)
     queryset = models.WorkflowActivity.objects.all()
     serializer_class = serializers.DelegateSerializer
@@ -444,6 +790,9 @@ class WorkflowActivityDelegateView(generics.ListCreateAPIView):
         return Response(serializer.data)
 
     def post(self, request, *arg, **kwargs):
+        return self.idempotent_response(self.delegate, request, *arg, **kwargs)
+
+    def delegate(self, request, *arg, **kwargs):
         instance = self.get_object()
         serializer = serializers.DelegateSerializer(data=request.data)
         if not serializer.is_valid():